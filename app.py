@@ -1,14 +1,19 @@
 import io
 import json
 from datetime import datetime
-from typing import Any, Dict, List, Tuple
+from operator import itemgetter
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Tuple
 
 import streamlit as st
+try:
+    import orjson
+except ImportError:  # sans orjson, parse_bytes se replie sur la lib standard
+    orjson = None
+from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
-from reportlab.lib.enums import TA_CENTER
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak, Flowable, Image
+from reportlab.lib.utils import ImageReader, simpleSplit
 from reportlab.pdfgen import canvas
+from reportlab.pdfgen.textobject import PDFTextObject
 from reportlab.lib.units import mm
 
 # ---------------------------- Streamlit UI ---------------------------- #
@@ -41,217 +46,304 @@ def node_title(node: Dict[str, Any]) -> str:
     t = node.get("title") or node.get("data", {}).get("name") or f"Élément {node.get('id','?')}"
     return str(t).strip()
 
-def load_all_trees(files) -> List[Dict[str, Any]]:
-    trees: List[Dict[str, Any]] = []
-    for f in files:
-        try:
-            data = json.loads(f.read().decode("utf-8"))
-            tree = data.get("data", {}).get("hierarchicalTreeData", [])
-            if isinstance(tree, list):
-                trees.extend(tree)
-        except Exception as e:
-            st.warning(f"⚠️ Impossible de lire {getattr(f,'name','(sans nom)')} : {e}")
-    return trees
-
 def hex_to_rgb01(hex_color: str) -> tuple[float, float, float]:
     hex_color = hex_color.lstrip("#")
     return (int(hex_color[0:2], 16)/255.0,
             int(hex_color[2:4], 16)/255.0,
             int(hex_color[4:6], 16)/255.0)
 
-def has_any_course(root: Dict[str, Any]) -> bool:
-    stack = [root]
-    while stack:
-        n = stack.pop()
-        if n.get("type") == "cours":
-            return True
-        stack.extend(ensure_list(n.get("children")))
-    return False
+def unique_sorted(titles: List[str]) -> List[str]:
+    # Dédoublonnage qui garde l'ordre d'apparition, puis tri insensible à la casse (clé str.lower, sans lambda)
+    out = list(dict.fromkeys(titles))
+    out.sort(key=str.lower)
+    return out
+
+class FacScan(NamedTuple):
+    has_course: bool
+    matieres: List[Tuple[str, List[str]]]
+    orphans: List[str]
 
-def collect_matieres_and_courses(fac: Dict[str, Any]) -> List[Tuple[str, List[str]]]:
+def scan_fac(fac: Dict[str, Any]) -> FacScan:
     """
-    Détecte les 'matières' comme:
+    Parcours unique (DFS à pile explicite) d'une fac. Détecte les 'matières' comme:
       - nœuds type 'ue' avec isFolder == False
       - nœuds type 'category'
-    Puis collecte tous les descendants 'cours' de chaque matière.
-    Renvoie [(label_matiere, [cours triés]), ...] en conservant l'ordre de parcours.
+    Une matière imbriquée dans une autre est rattachée à la plus haute. Les 'cours' sont des feuilles.
+    Chaque 'cours' est rangé dans sa matière ; ceux hors de toute matière vont dans les orphelins.
+    Renvoie FacScan(has_course, [(label_matiere, [cours triés]), ...], [orphelins triés]),
+    les matières étant dans l'ordre du parcours en largeur (ordre visuel).
     """
-    matieres: List[Tuple[str, List[str]]] = []
-    stack = ensure_list(fac.get("children"))
+    found: List[Tuple[int, str, List[str]]] = []  # (profondeur, label, cours)
+    orphans: List[str] = []
+    any_cours = False
+    # (nœud, profondeur, liste des cours de la matière englobante ou None)
+    stack: List[Tuple[Dict[str, Any], int, List[str] | None]] = [
+        (n, 1, None) for n in reversed(ensure_list(fac.get("children")))
+    ]
     while stack:
-        n = stack.pop(0)  # parcours en largeur pour respecter l'ordre visuel
+        n, depth, cours = stack.pop()
         tp = n.get("type")
-        is_folder = bool(n.get("isFolder", False))
-
-        is_matiere = (tp == "ue" and not is_folder) or (tp == "category")
-        if is_matiere:
-            cours: List[str] = []
-            sub = [n]
-            while sub:
-                m = sub.pop()
-                if m.get("type") == "cours":
-                    cours.append(node_title(m))
-                else:
-                    sub.extend(ensure_list(m.get("children")))
-            cours = sorted(set(cours), key=lambda s: s.lower())
-            if cours:
-                matieres.append((node_title(n), cours))
-        else:
-            stack.extend(ensure_list(n.get("children")))
-    return matieres
+        if tp == "cours":
+            any_cours = True
+            (orphans if cours is None else cours).append(node_title(n))
+            continue
+        if cours is None and ((tp == "ue" and not n.get("isFolder", False)) or tp == "category"):
+            cours = []
+            found.append((depth, node_title(n), cours))
+        kids = n.get("children")
+        if kids:  # pas d'ensure_list ici : ni appel ni liste vide allouée par feuille
+            stack.extend((c, depth + 1, cours) for c in reversed(kids if type(kids) is list else (kids,)))
+
+    # Tri stable par profondeur : ordre préfixe -> ordre du parcours en largeur
+    found.sort(key=itemgetter(0))
+    matieres = [(label, unique_sorted(cours)) for _, label, cours in found if cours]
+    return FacScan(any_cours, matieres, unique_sorted(orphans))
+
+def load_json(raw: bytes) -> Any:
+    # orjson lit directement les bytes (pas de copie décodée en str). Il est plus strict que json
+    # (NaN/Infinity, entiers > 64 bits, surrogates isolés refusés) : json.loads reste le repli.
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw)
+
+def parse_bytes(raw: bytes) -> List[Dict[str, Any]]:
+    tree = load_json(raw).get("data", {}).get("hierarchicalTreeData", [])
+    return tree if isinstance(tree, list) else []
+
+# Cache partagé par toutes les sessions : borné pour ne pas garder chaque upload distinct indéfiniment
+@st.cache_data(show_spinner=False, max_entries=16, ttl=3600)
+def scan_bytes(raw: bytes) -> List[Tuple[str, Tuple[bool, List[Tuple[str, List[str]]], List[str]]]]:
+    """
+    Parse un fichier JSON et scanne chacune de ses facs.
+    Mis en cache sur le contenu du fichier : changer une couleur ou le titre ne relance ni le parsing ni les parcours.
+    Ne renvoie que des types natifs : le cache picklise sa valeur, et une classe du script (FacScan)
+    vit dans le __main__ que Streamlit remplace à chaque rerun.
+    """
+    return [(node_title(fac), tuple(scan_fac(fac))) for fac in parse_bytes(raw)]
 
-# --------------------------- PDF ----------------------------- #
+def load_all_facs(files) -> Tuple[List[Tuple[str, FacScan]], List[str]]:
+    # Renvoie les facs scannées et les messages d'erreur de lecture (affichés à chaque rerun par l'appelant)
+    facs: List[Tuple[str, FacScan]] = []
+    errors: List[str] = []
+    for f in files:
+        try:
+            facs.extend((name, FacScan(*scan)) for name, scan in scan_bytes(f.getvalue()))
+        except Exception as e:
+            errors.append(f"⚠️ Impossible de lire {getattr(f,'name','(sans nom)')} : {e}")
+    return facs, errors
 
-class HeaderBand(Flowable):
-    def __init__(self, height_mm: float, primary_rgb: tuple[float, float, float], brand_path: io.BytesIO | None):
-        super().__init__()
-        self.h = height_mm * mm
-        self.primary = primary_rgb
-        self.brand_path = brand_path
+# --------------------------- PDF ----------------------------- #
 
-    def draw(self):
-        c: canvas.Canvas = self.canv
-        width, height = c._pagesize
+PAGE_W, PAGE_H = A4
+MARGIN_X, MARGIN_TOP, MARGIN_BOTTOM = 18 * mm, 20 * mm, 18 * mm
+BAND_H, COVER_BAND_H = 16 * mm, 28 * mm       # bandeaux dessinés dans la marge haute
+CONTENT_TOP = PAGE_H - MARGIN_TOP - 10 * mm   # haut de la zone de texte, sous le bandeau
+
+PageCallback = Callable[[canvas.Canvas], None]
+
+class TextStyle(NamedTuple):
+    font: str
+    size: float
+    leading: float
+    indent: float = 0
+    space_before: float = 0
+    space_after: float = 0
+
+COVER_TITLE = TextStyle("Helvetica-Bold", 28, 32)
+COVER_META = TextStyle("Helvetica", 10, 12)
+FAC_TITLE = TextStyle("Helvetica-Bold", 22, 26, space_after=6)
+SECTION_TITLE = TextStyle("Helvetica-Bold", 15, 18, space_before=6, space_after=2)
+LIST_ITEM = TextStyle("Helvetica", 11.5, 15, indent=10)
+
+def load_brand(brand_img_bytes: bytes | None) -> ImageReader | None:
+    # Décodé une seule fois puis réutilisé sur chaque page ; une image illisible est ignorée
+    if not brand_img_bytes:
+        return None
+    try:
+        return ImageReader(io.BytesIO(brand_img_bytes))
+    except Exception:
+        return None
+
+def header_band(height: float, primary: colors.Color, brand: ImageReader | None) -> PageCallback:
+    """Callback de page (à la onFirstPage / onLaterPages de Platypus) : bandeau de couleur + logo en haut de page."""
+    def on_page(c: canvas.Canvas):
         c.saveState()
-        c.setFillColorRGB(*self.primary)
-        c.rect(0, height - self.h, width, self.h, stroke=0, fill=1)
-        if self.brand_path:
+        c.setFillColor(primary)
+        c.rect(0, PAGE_H - height, PAGE_W, height, stroke=0, fill=1)
+        if brand is not None:
             try:
                 margin = 8 * mm
-                max_h = self.h - 6 * mm
-                img = Image(self.brand_path, width=width - 2*margin, height=max_h)
-                iw, ih = img.wrap(width - 2*margin, max_h)
-                img.drawOn(c, (width - iw) / 2, height - self.h + (self.h - ih) / 2)
+                max_h = height - 6 * mm
+                c.drawImage(brand, margin, PAGE_H - height + (height - max_h) / 2, PAGE_W - 2*margin, max_h,
+                            preserveAspectRatio=True, anchor="c", mask="auto")
             except Exception:
                 pass
         c.restoreState()
+    return on_page
 
-def add_style_if_absent(styles, style: ParagraphStyle):
-    if style.name not in styles.byName:
-        styles.add(style)
-
-def build_pdf(trees: List[Dict[str, Any]],
+class PageWriter:
+    """
+    Curseur vertical sur le canvas : écrit des lignes de texte de haut en bas
+    et passe à une nouvelle page quand la marge basse est atteinte.
+    Chaque nouvelle page est décorée par on_first_page (1re page du canvas) ou on_later_pages.
+    Tout le texte d'une page est accumulé dans un seul TextObject (un bloc BT/ET),
+    police et couleur n'étant réémises que lorsqu'elles changent.
+    """
+    def __init__(self, c: canvas.Canvas, on_first_page: PageCallback, on_later_pages: PageCallback):
+        self.c = c
+        self.on_first_page = on_first_page
+        self.on_later_pages = on_later_pages
+        self.pages = 0
+        self.y = CONTENT_TOP
+        self.text: PDFTextObject | None = None
+        self._font: tuple[str, float, float] | None = None
+        self._color: colors.Color | None = None
+        self._next: tuple[float, float] | None = None  # position du curseur texte après le dernier textLine
+
+    def start_page(self):
+        (self.on_later_pages if self.pages else self.on_first_page)(self.c)
+        self.pages += 1
+        self.y = CONTENT_TOP
+        self.text = self.c.beginText()
+        self._font = self._color = self._next = None
+
+    def end_page(self):
+        if self.text is not None:
+            self.c.drawText(self.text)
+            self.text = None
+        self.c.showPage()
+
+    def skip(self, dy: float):
+        self.y -= dy
+
+    def paragraph(self, text: str, style: TextStyle, color: colors.Color, centred: bool = False):
+        self.paragraphs((text,), style, color, centred)
+
+    def paragraphs(self, texts: Iterable[str], style: TextStyle, color: colors.Color, centred: bool = False):
+        """
+        Écrit une suite de paragraphes de même style d'un seul tenant (ex. toutes les puces d'une matière).
+        Une seule mesure de largeur par paragraphe : le découpage en mots (simpleSplit) n'est fait
+        que pour ceux qui dépassent la largeur utile.
+        """
+        c = self.c
+        font = (style.font, style.size, style.leading)
+        width = PAGE_W - 2 * MARGIN_X - style.indent
+        for text in texts:
+            self.y -= style.space_before
+            if c.stringWidth(text, style.font, style.size) <= width:
+                lines = (text,)
+            else:
+                lines = simpleSplit(text, style.font, style.size, width)
+            for line in lines:
+                if self.y - style.leading < MARGIN_BOTTOM:
+                    self.end_page()
+                    self.start_page()
+                self.y -= style.leading
+                t = self.text
+                if font != self._font:
+                    t.setFont(*font)
+                    self._font = font
+                if color is not self._color:
+                    t.setFillColor(color)
+                    self._color = color
+                if centred:
+                    x = (PAGE_W - c.stringWidth(line, style.font, style.size)) / 2
+                else:
+                    x = MARGIN_X + style.indent
+                # Lignes consécutives de même style : simple T* (textLine), sans repositionnement
+                if (x, self.y) != self._next:
+                    t.setTextOrigin(x, self.y)
+                t.textLine(line)
+                self._next = (x, self.y - style.leading)
+            self.y -= style.space_after
+
+class StyleCtx(NamedTuple):
+    primary: colors.Color            # titres / bandeau
+    text: colors.Color               # corps
+    brand_img_bytes: bytes | None
+
+def new_page_writer(c: canvas.Canvas, style: StyleCtx, cover: bool) -> PageWriter:
+    brand = load_brand(style.brand_img_bytes)
+    on_later_pages = header_band(BAND_H, style.primary, brand)
+    on_first_page = header_band(COVER_BAND_H, style.primary, brand) if cover else on_later_pages
+    return PageWriter(c, on_first_page, on_later_pages)
+
+def draw_cover(page: PageWriter, title_text: str, style: StyleCtx):
+    page.start_page()
+    page.skip(12 * mm)
+    page.paragraph(title_text, COVER_TITLE, style.primary, centred=True)
+    page.skip(8 * mm)
+    today = datetime.now().strftime("%d %B %Y")
+    page.paragraph(f"Généré le {today}", COVER_META, style.text, centred=True)
+    page.end_page()
+
+def draw_fac(page: PageWriter, fac_name: str, scan: FacScan, style: StyleCtx):
+    page.start_page()
+    page.paragraph(fac_name, FAC_TITLE, style.primary)
+
+    if scan.matieres:
+        for mat_label, cours in scan.matieres:
+            page.paragraph(mat_label, SECTION_TITLE, style.primary)
+            page.paragraphs([f"• {ctitle}" for ctitle in cours], LIST_ITEM, style.text)
+            page.skip(3 * mm)
+    elif scan.orphans:
+        # La fac n'a que des cours “hors matière” : on les affiche groupés sous "Autres".
+        page.paragraph("Autres", SECTION_TITLE, style.primary)
+        page.paragraphs([f"• {ct}" for ct in scan.orphans], LIST_ITEM, style.text)
+
+    page.end_page()
+
+def build_pdf(facs: List[Tuple[str, FacScan]],
               primary_hex: str,
               text_hex: str,
               brand_img_bytes: bytes | None,
               title_text: str,
               show_cover: bool) -> bytes:
     buf = io.BytesIO()
-    doc = SimpleDocTemplate(
-        buf,
-        pagesize=A4,
-        leftMargin=18*mm, rightMargin=18*mm, topMargin=20*mm, bottomMargin=18*mm
-    )
-
-    primary_rgb01 = hex_to_rgb01(primary_hex)
-
-    styles = getSampleStyleSheet()
-
-    # TITRES EN VIOLET (couleur principale)
-    add_style_if_absent(styles, ParagraphStyle(
-        name="CoverTitle",
-        fontName="Helvetica-Bold",
-        fontSize=28,
-        alignment=TA_CENTER,
-        textColor=primary_hex,
-        leading=32,
-    ))
-    add_style_if_absent(styles, ParagraphStyle(
-        name="FacTitle",
-        fontName="Helvetica-Bold",
-        fontSize=22,
-        textColor=primary_hex,
-        leading=26,
-        spaceAfter=6,
-    ))
-    add_style_if_absent(styles, ParagraphStyle(
-        name="SectionTitle",
-        fontName="Helvetica-Bold",
-        fontSize=15,
-        textColor=primary_hex,
-        leading=18,
-        spaceBefore=6,
-        spaceAfter=2,
-    ))
-    # Corps en couleur de texte
-    add_style_if_absent(styles, ParagraphStyle(
-        name="ListItem",
-        fontName="Helvetica",
-        fontSize=11.5,
-        textColor=text_hex,
-        leading=15,
-        leftIndent=10,
-    ))
-
-    story: List[Any] = []
 
-    # -- Couverture
-    if show_cover:
-        band = HeaderBand(height_mm=28, primary_rgb=primary_rgb01,
-                          brand_path=io.BytesIO(brand_img_bytes) if brand_img_bytes else None)
-        story.append(band)
-        story.append(Spacer(1, 22 * mm))
-        story.append(Paragraph(title_text, styles["CoverTitle"]))
-        story.append(Spacer(1, 8 * mm))
-        today = datetime.now().strftime("%d %B %Y")
-        story.append(Paragraph(f"Généré le {today}", ParagraphStyle(name="CoverMeta", textColor=text_hex, alignment=TA_CENTER)))
-        story.append(PageBreak())
+    # TITRES EN VIOLET (couleur principale), corps en couleur de texte.
+    # Couleurs converties une seule fois, puis partagées par toutes les pages.
+    style = StyleCtx(colors.Color(*hex_to_rgb01(primary_hex)), colors.Color(*hex_to_rgb01(text_hex)), brand_img_bytes)
 
     # -- Filtrer les facs sans aucun cours
-    facs_effectives = []
-    for fac in trees:
-        if has_any_course(fac):
-            facs_effectives.append(fac)
+    facs_effectives = [(name, scan) for name, scan in facs if scan.has_course]
+
+    c = canvas.Canvas(buf, pagesize=A4)
+    page = new_page_writer(c, style, cover=show_cover)
+
+    # -- Couverture
+    if show_cover:
+        draw_cover(page, title_text, style)
 
     # -- Contenu : 1 fac minimum par page
-    for idx, fac in enumerate(facs_effectives):
-        band = HeaderBand(height_mm=16, primary_rgb=primary_rgb01,
-                          brand_path=io.BytesIO(brand_img_bytes) if brand_img_bytes else None)
-        story.append(band)
-        story.append(Spacer(1, 10 * mm))
-
-        fac_name = node_title(fac)
-        story.append(Paragraph(fac_name, styles["FacTitle"]))
-
-        matieres = collect_matieres_and_courses(fac)
-
-        if not matieres:
-            # Si on arrive ici, c'est que la fac avait des cours “hors matière” détectés par has_any_course,
-            # mais aucune matière éligible. On affiche au moins les cours orphelins groupés sous "Autres".
-            # Collecte cours globaux:
-            orphan_courses: List[str] = []
-            stack = ensure_list(fac.get("children"))
-            while stack:
-                n = stack.pop()
-                if n.get("type") == "cours":
-                    orphan_courses.append(node_title(n))
-                else:
-                    stack.extend(ensure_list(n.get("children")))
-            orphan_courses = sorted(set(orphan_courses), key=lambda s: s.lower())
-            if orphan_courses:
-                story.append(Paragraph("Autres", styles["SectionTitle"]))
-                for ct in orphan_courses:
-                    story.append(Paragraph(f"• {ct}", styles["ListItem"]))
-        else:
-            for mat_label, cours in matieres:
-                story.append(Paragraph(mat_label, styles["SectionTitle"]))
-                for ctitle in cours:
-                    story.append(Paragraph(f"• {ctitle}", styles["ListItem"]))
-                story.append(Spacer(1, 3 * mm))
-
-        if idx < len(facs_effectives) - 1:
-            story.append(PageBreak())
-
-    doc.build(story)
-    buf.seek(0)
-    return buf.read()
+    for fac_name, scan in facs_effectives:
+        draw_fac(page, fac_name, scan, style)
+
+    if not (show_cover or facs_effectives):
+        page.end_page()  # un PDF valide contient au moins une page
+
+    c.save()
+    return buf.getvalue()
 
 # ---------------------------- Main action ---------------------------- #
 
 if files:
-    trees = load_all_trees(files)
-    total_facs = len(trees)
-    facs_with_courses = [t for t in trees if has_any_course(t)]
+    # Parsing + scans faits une seule fois par jeu de fichiers : les reruns déclenchés par les
+    # widgets (couleurs, titre...) réutilisent le résultat sans relire ni re-hasher les uploads.
+    files_sig = tuple((f.file_id, f.name, f.size) for f in files)
+    if st.session_state.get("files_sig") != files_sig:
+        st.session_state["facs"], st.session_state["load_errors"] = load_all_facs(files)
+        # En cas d'erreur, la signature n'est pas mémorisée : le prochain rerun retente la lecture
+        st.session_state["files_sig"] = None if st.session_state["load_errors"] else files_sig
+    facs = st.session_state["facs"]
+    for msg in st.session_state["load_errors"]:
+        st.warning(msg)
+
+    total_facs = len(facs)
+    facs_with_courses = [name for name, scan in facs if scan.has_course]
     skipped = total_facs - len(facs_with_courses)
 
     st.success(f"✅ {len(facs_with_courses)} faculté(s) avec cours détectée(s).")
@@ -259,13 +351,13 @@ if files:
         st.info(f"ℹ️ {skipped} faculté(s) sans cours ont été ignorées.")
 
     with st.expander("Aperçu (facultés retenues)"):
-        for i, fac in enumerate(facs_with_courses, start=1):
-            st.write(f"{i}. {node_title(fac)}")
+        for i, name in enumerate(facs_with_courses, start=1):
+            st.write(f"{i}. {name}")
 
     if st.button("📄 Générer le PDF") or generate_btn_top:
         brand_bytes = brand_img.read() if brand_img else None
         pdf_bytes = build_pdf(
-            trees=trees,
+            facs=facs,
             primary_hex=primary_hex,
             text_hex=text_hex,
             brand_img_bytes=brand_bytes,